@@ -1,15 +1,22 @@
+import io
 import re
 import json
 import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from typing import List, Dict, Any
-from pydub import AudioSegment
-import pysrt
+import numpy as np
 from openai import OpenAI
 from dotenv import load_dotenv
 import os
 from caption_position import detect_face_position
+from caption_timing import resolve_overlaps, save_srt
+from video_encoder import (
+    DEFAULT_ENCODER, SUBS_FORMAT_FIRST, X264_THREADS,
+    device_args, encoder_args, ffmpeg_escape, run_with_fallback, video_filter,
+)
 
 
 # === ENV SETUP ===
@@ -39,6 +46,19 @@ def get_openai_client() -> OpenAI:
     return _client
 
 
+# === AUDIO CHUNKING ===
+CHUNK_MS = 9 * 60 * 1000      # stay under the 25 MB Whisper API upload limit
+MAX_PARALLEL_CHUNKS = 6
+
+
+# === PATTERNS ===
+_TITLE_PUNCT = re.compile(r"[^\w\s-]")
+_TITLE_WS = re.compile(r"\s+")
+_SENTENCE_END = re.compile(r"[.!?]$")
+_SILENCE_START = re.compile(r"silence_start: (-?[\d.]+)")
+_SILENCE_END = re.compile(r"silence_end: ([\d.]+)")
+
+
 # === PATHS ===
 BASE_DIR = Path(__file__).resolve().parent.parent
 OUTPUTS_DIR = BASE_DIR / "outputs"
@@ -50,21 +70,31 @@ SRT_DIR.mkdir(parents=True, exist_ok=True)
 
 # === HELPERS ===
 def clean_title(t: str) -> str:
-    return re.sub(r"\s+", "_", re.sub(r"[^\w\s-]", "", t)).strip("_")
+    return _TITLE_WS.sub("_", _TITLE_PUNCT.sub("", t)).strip("_")
 
 
-def ffmpeg_escape(p: Path) -> str:
-    return str(p).replace("\\", "\\\\").replace(":", "\\:").replace("'", r"\'").replace(",", r"\,")
+def probe_duration(path) -> float:
+    """Container duration in seconds via ffprobe (no decode)."""
+    out = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", str(path)],
+        capture_output=True, text=True, check=True,
+    ).stdout.strip()
+    return float(out or 0)
 
 
-def chunk_audio(f: Path, max_ms=9 * 60 * 1000) -> List[Path]:
-    """Split long audio for API chunking."""
-    audio = AudioSegment.from_file(str(f))
+def chunk_audio(f: Path, max_ms=CHUNK_MS) -> List[io.BytesIO]:
+    """Split long audio for API chunking — in-memory mp3 slices, ffmpeg stream copy to stdout."""
+    duration_ms = int(probe_duration(f) * 1000)
     out = []
-    for i in range(0, len(audio), max_ms):
-        tmp = Path(tempfile.mkstemp(suffix=f".chunk{i//max_ms+1}.mp3")[1])
-        audio[i:i + max_ms].export(tmp, format="mp3")
-        out.append(tmp)
+    for i, start in enumerate(range(0, duration_ms, max_ms), 1):
+        data = subprocess.run(
+            ["ffmpeg", "-loglevel", "error", "-ss", f"{start / 1000:g}", "-t", f"{max_ms / 1000:g}",
+             "-i", str(f), "-c", "copy", "-f", "mp3", "-"],
+            capture_output=True, check=True,
+        ).stdout
+        buf = io.BytesIO(data)
+        buf.name = f"chunk{i}.mp3"  # the SDK infers the upload format from the name
+        out.append(buf)
     return out
 
 
@@ -86,21 +116,33 @@ def _to_dict(x: Any) -> Dict[str, Any]:
 
 def trim_leading_silence(filepath: str, silence_threshold=-30.0, chunk_ms=10):
     """Remove initial silence to help Whisper start cleanly."""
-    audio = AudioSegment.from_file(filepath)
-    trim_ms = 0
-    while trim_ms < len(audio) and audio[trim_ms:trim_ms+chunk_ms].dBFS < silence_threshold:
-        trim_ms += chunk_ms
-    trimmed = audio[trim_ms:]
-    trimmed.export(filepath, format="mp3")
-    if trim_ms > 0:
-        print(f"[INFO] Trimmed {trim_ms/1000:.2f}s of leading silence from {filepath}")
+    # silencedetect scans the samples inside ffmpeg; the cut itself is a stream copy
+    log = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-nostats", "-i", filepath,
+         "-af", f"silencedetect=noise={silence_threshold}dB:d={chunk_ms / 1000}",
+         "-f", "null", "-"],
+        capture_output=True, text=True, check=True,
+    ).stderr
+    start, end = _SILENCE_START.search(log), _SILENCE_END.search(log)
+    if not start or not end or float(start.group(1)) > chunk_ms / 1000:
+        return
+
+    trim_s = float(end.group(1))
+    src = Path(filepath)
+    trimmed = src.with_name(f"{src.stem}.trimmed{src.suffix}")
+    subprocess.run(
+        ["ffmpeg", "-loglevel", "error", "-ss", f"{trim_s:.3f}", "-i", filepath,
+         "-c", "copy", "-y", str(trimmed)],
+        check=True,
+    )
+    trimmed.replace(src)
+    print(f"[INFO] Trimmed {trim_s:.2f}s of leading silence from {filepath}")
 
 
 # === FALLBACK SEGMENTATION ===
 def fallback_segment_text(text: str, audio_path: str, words_per_segment: int = 7) -> List[Dict[str, Any]]:
     """Generate synthetic timestamped segments when Whisper returns text only."""
-    audio = AudioSegment.from_file(audio_path)
-    duration_sec = len(audio) / 1000
+    duration_sec = probe_duration(audio_path)
     words = text.split()
     if not words:
         return []
@@ -130,8 +172,9 @@ def generate_captions(audio_path: str) -> List[Dict[str, Any]]:
     trim_leading_silence(audio_path)
     client = get_openai_client()
     chunks = chunk_audio(Path(audio_path))
+    # chunk k starts at k * CHUNK_MS, so offsets are known before any request returns
+    offsets = [k * CHUNK_MS / 1000 for k in range(len(chunks))]
     segments_all = []
-    offset = 0.0
 
     def _dedup(prev_text, new_text):
         """Remove overlap between consecutive segments."""
@@ -142,22 +185,26 @@ def generate_captions(audio_path: str) -> List[Dict[str, Any]]:
                 break
         return new_text[overlap_len:].strip()
 
-    last_text = ""
+    def _transcribe(ch: io.BytesIO) -> Dict[str, Any]:
+        if not ch.getbuffer().nbytes:
+            raise RuntimeError(f"Invalid audio chunk: {ch.name}")
 
-    for i, ch in enumerate(chunks, 1):
-        if not ch.exists() or ch.stat().st_size == 0:
-            raise RuntimeError(f"Invalid audio chunk: {ch}")
+        result = client.audio.transcriptions.create(
+            model="whisper-1",
+            file=ch,
+            response_format="verbose_json",
+            timestamp_granularities=["word"],
+            language="en"
+        )
+        return _to_dict(result)
 
-        with open(ch, "rb") as f:
-            result = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=f,
-                response_format="verbose_json",
-                timestamp_granularities=["word"],
-                language="en"
-            )
+    # chunks are independent → fire the API calls concurrently, keep results in order
+    with ThreadPoolExecutor(max_workers=max(1, min(len(chunks), MAX_PARALLEL_CHUNKS))) as pool:
+        results = list(pool.map(_transcribe, chunks))
 
-        d = _to_dict(result)
+    last_text = ""
+
+    for i, (d, offset) in enumerate(zip(results, offsets), 1):
         segs = d.get("segments") or []
 
         # Fallback path (no timestamp data)
@@ -203,7 +250,7 @@ def generate_captions(audio_path: str) -> List[Dict[str, Any]]:
 
                 chunk.append(word_text)
                 # chunk cutoff: 3 words or punctuation
-                if len(chunk) >= 3 or re.search(r"[.!?]$", word_text):
+                if len(chunk) >= 3 or _SENTENCE_END.search(word_text):
                     chunk_end = word_end
                     text = " ".join(chunk).strip()
                     # deduplicate overlapping continuation
@@ -230,51 +277,30 @@ def generate_captions(audio_path: str) -> List[Dict[str, Any]]:
                     })
                     last_text = text
 
-        offset += segs[-1].get("end", 0)
-        ch.unlink(missing_ok=True)
         print(f"[INFO] Chunk {i}/{len(chunks)} processed ({len(segs)} segments)")
 
     if not segments_all:
         raise RuntimeError("❌ No segments returned from Whisper API.")
 
-    # smoothing
-    for j in range(1, len(segments_all)):
-        if segments_all[j]["start"] < segments_all[j-1]["end"]:
-            segments_all[j]["start"] = segments_all[j-1]["end"] + 0.08
-    if segments_all:
-        segments_all[-1]["end"] += 0.4
+    # smoothing: every caption ≥0.3 s and ≥0.08 s after the previous one, in one vectorized pass
+    starts, ends = resolve_overlaps(
+        np.array([seg["start"] for seg in segments_all]),
+        np.array([seg["end"] for seg in segments_all]),
+        gap=0.08, min_dur=0.3,
+    )
+    ends[-1] += 0.4
+    for seg, start, end in zip(segments_all, np.round(starts, 2).tolist(), np.round(ends, 2).tolist()):
+        seg["start"], seg["end"] = start, end
 
     print(f"[INFO] ✅ {len(segments_all)} clean caption chunks generated.")
     return segments_all
 
 
-# === SAVE SRT ===
-def save_srt(segments: List[Dict[str, Any]], srt_path: Path):
-    subs = pysrt.SubRipFile()
-    for i, seg in enumerate(segments, start=1):
-        subs.append(
-            pysrt.SubRipItem(
-                index=i,
-                start=pysrt.SubRipTime(seconds=seg["start"]),
-                end=pysrt.SubRipTime(seconds=seg["end"]),
-                text=seg["text"]
-            )
-        )
-    srt_path.parent.mkdir(parents=True, exist_ok=True)
-    subs.save(srt_path, encoding="utf-8")
-
-
 # === BURN SUBTITLES ===
-def burn_subtitles(video_path: Path, srt_path: Path, output_path: Path, alignment=2, margin=None):
-    if margin is None:
-        if alignment in [1, 2, 3]:
-            margin = 100
-        elif alignment in [4, 5, 6]:
-            margin = 20
-        else:
-            margin = 150
-
-    style = (
+@lru_cache(maxsize=32)
+def _style(alignment: int, margin: int) -> str:
+    """ASS force_style for one (alignment, margin) pair, built once and reused."""
+    return (
         f"Fontname=Arial Black,"
         f"Fontsize=18,"
         f"Bold=1,"
@@ -287,61 +313,75 @@ def burn_subtitles(video_path: Path, srt_path: Path, output_path: Path, alignmen
         f"Alignment={alignment},"
         f"MarginV={margin},MarginL=20,MarginR=20,WrapStyle=2"
     )
-    vf = f"subtitles='{ffmpeg_escape(srt_path)}':force_style='{style}',format=yuv420p"
+
+
+def burn_subtitles(video_path: Path, srt_path: Path, output_path: Path, alignment=2, margin=None,
+                   encoder=DEFAULT_ENCODER):
+    if margin is None:
+        if alignment in [1, 2, 3]:
+            margin = 100
+        elif alignment in [4, 5, 6]:
+            margin = 20
+        else:
+            margin = 150
+
+    subs = f"subtitles='{ffmpeg_escape(srt_path)}':force_style='{_style(alignment, margin)}'"
+    vf = f"format=yuv420p,{subs}" if SUBS_FORMAT_FIRST else f"{subs},format=yuv420p"
     output_path.parent.mkdir(parents=True, exist_ok=True)
 
-    subprocess.run(
-        [
+    def _cmd(enc, audio_args):
+        return [
             "ffmpeg", "-loglevel", "error",
+            "-filter_threads", str(X264_THREADS),
+            *device_args(enc),
             "-i", str(video_path),
-            "-vf", vf,
-            "-c:v", "libx264", "-preset", "fast", "-crf", "22",
-            "-c:a", "aac", "-b:a", "128k", "-movflags", "+faststart",
+            "-map", "0:v:0", "-map", "0:a:0?",
+            "-vf", video_filter(vf, enc),
+            *encoder_args(enc, 22),
+            *audio_args, "-movflags", "+faststart",
             "-y", str(output_path)
-        ],
-        check=True
-    )
+        ]
+
+    run_with_fallback(_cmd, encoder)
 
 
 # === MAIN PIPELINE ===
 def process_caption_video(youtube_url: str):
     tmpdir = Path(tempfile.mkdtemp())
+    audio_path = tmpdir / "audio.mp3"
+    video_path = tmpdir / "video.mp4"
+
+    # one download for everything; the title is printed by the same invocation
     raw_title = subprocess.run(
-        ["yt-dlp", "--get-title", youtube_url],
-        capture_output=True, text=True, check=True,
+        ["yt-dlp", "--print", "title", "--no-simulate",
+         "-f", "bestvideo[ext=mp4][vcodec^=avc1]+bestaudio[ext=m4a]/mp4",
+         "-o", str(video_path), youtube_url],
+        stdout=subprocess.PIPE, text=True, check=True,
     ).stdout.strip()
-    title = clean_title(raw_title) or "video"
 
-    audio_path = tmpdir / "audio.mp3"
-    video_path = tmpdir / "video.mp4"
+    title = clean_title(raw_title) or "video"
     srt_path = SRT_DIR / f"{title}.srt"
     out_video = VIDEOS_DIR / f"{title}_captioned.mp4"
 
-    subprocess.run(
-        ["yt-dlp", "-f", "bestaudio", "-x", "--audio-format", "mp3",
-         "-o", str(audio_path), youtube_url],
-        check=True
-    )
-    subprocess.run(
-        ["yt-dlp", "-f", "bestvideo[ext=mp4][vcodec^=avc1]+bestaudio[ext=m4a]/mp4",
-         "-o", str(video_path), youtube_url],
-        check=True
-    )
-
-    if not audio_path.exists() or audio_path.stat().st_size == 0:
-        raise RuntimeError("Audio download failed")
     if not video_path.exists() or video_path.stat().st_size == 0:
         raise RuntimeError("Video download failed")
 
-    segments = generate_captions(str(audio_path))
-    save_srt(segments, srt_path)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        # face detection only needs the video → run it while audio is extracted / transcribed
+        align_future = pool.submit(detect_face_position, str(video_path))
 
-    try:
-        align = int(detect_face_position(str(video_path)))
-        if align not in range(1, 10):
-            align = 2
-    except Exception:
-        align = 2
+        # audio comes from the local file: 16 kHz mono mp3 is all Whisper uses and keeps uploads small
+        subprocess.run(
+            ["ffmpeg", "-loglevel", "error", "-i", str(video_path),
+             "-vn", "-ac", "1", "-ar", "16000", "-c:a", "libmp3lame", "-b:a", "64k", "-y", str(audio_path)],
+            check=True,
+        )
+        if not audio_path.exists() or audio_path.stat().st_size == 0:
+            raise RuntimeError("Audio extraction failed")
+
+        segments = generate_captions(str(audio_path))
+        save_srt(segments, srt_path)
+        align = align_future.result()
 
     burn_subtitles(video_path, srt_path, out_video, align)
 
@@ -1,86 +1,191 @@
-# import cv2
-# import numpy as np
-
-# ==============================
-# ORIGINAL — Whisper (with OpenCV)
-# ==============================
-#
-# def detect_face_position(video_path: str, sample_frames=10):
-#     """
-#     Detect face position in video to determine best caption placement.
-#     
-#     Returns SSA alignment value:
-#     - 2: Bottom center (face in top/middle)
-#     - 8: Top center (face in bottom)
-#     - 5: Middle center (no face detected or centered face)
-#     """
-#     cap = cv2.VideoCapture(video_path)
-#     
-#     if not cap.isOpened():
-#         print(f"Warning: Could not open video {video_path}, defaulting to bottom")
-#         return 2  # Default to bottom
-#     
-#     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-#     frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-#     
-#     if total_frames == 0 or frame_height == 0:
-#         cap.release()
-#         return 2
-#     
-#     # Load face detection cascade
-#     face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-#     
-#     face_positions = []
-#     
-#     frame_indices = np.linspace(0, total_frames - 1, min(sample_frames, total_frames), dtype=int)
-#     
-#     for frame_idx in frame_indices:
-#         cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-#         ret, frame = cap.read()
-#         
-#         if not ret:
-#             continue
-#         
-#         gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-#         
-#         faces = face_cascade.detectMultiScale(
-#             gray,
-#             scaleFactor=1.1,
-#             minNeighbors=5,
-#             minSize=(30, 30)
-#         )
-#         
-#         for (x, y, w, h) in faces:
-#             face_center_y = y + h / 2
-#             normalized_position = face_center_y / frame_height
-#             face_positions.append(normalized_position)
-#     
-#     cap.release()
-#     
-#     if not face_positions:
-#         return 2
-#     
-#     avg_position = np.mean(face_positions)
-#     
-#     if avg_position < 0.33:
-#         return 2  # Face top third → captions bottom
-#     elif avg_position > 0.67:
-#         return 8  # Face bottom third → captions top
-#     else:
-#         return 2  # Face middle → bottom preferred
-
-
-# ==============================
-# OPENAI DEPLOYMENT — Lightweight fallback
-# ==============================
-
-def detect_face_position(video_path: str, sample_frames=10):
+"""
+caption_position.py — face-aware caption placement.
+Samples a few frames with ffmpeg and runs a face detector on them as a single batch:
+UltraFace via ONNX Runtime when available, otherwise OpenCV's res10 SSD.
+Falls back to bottom-center when neither backend (or its model file) is present.
+"""
+
+import json
+import os
+import subprocess
+import threading
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+try:
+    import cv2
+except ImportError:  # OpenAI deployment ships without OpenCV
+    cv2 = None
+
+
+# === MODEL SETUP ===
+MODELS_DIR = Path(__file__).resolve().parent / "models"
+FACE_PROTOTXT = MODELS_DIR / "deploy.prototxt"
+FACE_CAFFEMODEL = MODELS_DIR / "res10_300x300_ssd_iter_140000.caffemodel"
+FACE_SIZE = 300
+ULTRAFACE_ONNX = MODELS_DIR / "version-RFB-320.onnx"
+ULTRAFACE_SIZE = (320, 240)  # width, height
+SHORTS_ASPECT = 1.6  # height / width above which a clip is treated as portrait (9:16 ≈ 1.78)
+SHORTS_MAX_SECONDS = 60
+_net = None
+_net_lock = threading.Lock()  # cv2.dnn.Net is not thread-safe and forward() releases the GIL
+_session = None
+
+
+def _get_face_session():
+    """Lazy-load the UltraFace ONNX Runtime session once, preferring CUDA when present."""
+    global _session
+    if _session is None and ort is not None and ULTRAFACE_ONNX.exists():
+        available = ort.get_available_providers()
+        providers = [p for p in ("CUDAExecutionProvider", "CPUExecutionProvider") if p in available]
+        _session = ort.InferenceSession(str(ULTRAFACE_ONNX), providers=providers)
+    return _session
+
+
+def _get_face_net():
+    """Lazy-load the SSD face detector once; None when detection is unavailable."""
+    global _net
+    if _net is None and cv2 is not None and FACE_PROTOTXT.exists() and FACE_CAFFEMODEL.exists():
+        _net = cv2.dnn.readNetFromCaffe(str(FACE_PROTOTXT), str(FACE_CAFFEMODEL))
+        _net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        _net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+    return _net
+
+
+# === FRAME SAMPLING ===
+def _probe_video(video_path: str) -> tuple[int, int, float]:
+    """Width, height and duration of the first video stream from a single ffprobe call."""
+    out = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v:0",
+         "-show_entries", "stream=width,height:format=duration", "-of", "json", video_path],
+        capture_output=True, text=True, check=True
+    ).stdout
+    info = json.loads(out or "{}")
+    stream = (info.get("streams") or [{}])[0]
+    try:
+        duration = float(info.get("format", {}).get("duration", 0))
+    except ValueError:
+        duration = 0.0
+    return int(stream.get("width") or 0), int(stream.get("height") or 0), duration
+
+
+def _sample_frames(video_path: str, duration: float, sample_frames: int, width: int, height: int,
+                   pix_fmt: str = "bgr24") -> np.ndarray:
+    """
+    Decode evenly spaced, detector-sized frames in one sequential ffmpeg pass (no seeking).
+    Only keyframes are decoded; the fps filter picks the nearest one for each sample slot.
+    """
+    if duration <= 0:
+        return np.empty((0, height, width, 3), dtype=np.uint8)
+
+    raw = subprocess.run(
+        [
+            "ffmpeg", "-loglevel", "error",
+            "-skip_frame", "nokey", "-i", video_path, "-an",
+            "-vf", f"fps={sample_frames / duration},scale={width}:{height}",
+            "-frames:v", str(sample_frames),
+            "-f", "rawvideo", "-pix_fmt", pix_fmt, "-"
+        ],
+        capture_output=True, check=True
+    ).stdout
+    return np.frombuffer(raw, dtype=np.uint8).reshape(-1, height, width, 3)
+
+
+# === DETECTORS ===
+# Each returns the normalized y-centers of all confident faces across the sampled frames.
+def _ultraface_centers(session, video_path: str, duration: float, sample_frames: int,
+                       min_confidence: float) -> np.ndarray:
+    width, height = ULTRAFACE_SIZE
+    frames = _sample_frames(video_path, duration, sample_frames, width, height, pix_fmt="rgb24")
+    if not len(frames):
+        return np.empty(0)
+
+    batch = ((frames.astype(np.float32) - 127.0) / 128.0).transpose(0, 3, 1, 2)  # NHWC → NCHW
+    input_name = session.get_inputs()[0].name
+    if session.get_inputs()[0].shape[0] == 1:  # static-batch export: one frame per run
+        outputs = [session.run(["scores", "boxes"], {input_name: batch[i:i + 1]}) for i in range(len(batch))]
+        scores = np.concatenate([o[0] for o in outputs])
+        boxes = np.concatenate([o[1] for o in outputs])
+    else:
+        scores, boxes = session.run(["scores", "boxes"], {input_name: batch})
+
+    # scores: (N, anchors, [background, face]); boxes: (N, anchors, [x1, y1, x2, y2]) normalized
+    faces = boxes[scores[..., 1] > min_confidence]
+    return (faces[:, 1] + faces[:, 3]) / 2
+
+
+def _ssd_centers(net, video_path: str, duration: float, sample_frames: int, min_confidence: float) -> np.ndarray:
+    frames = _sample_frames(video_path, duration, sample_frames, FACE_SIZE, FACE_SIZE)
+    if not len(frames):
+        return np.empty(0)
+
+    # one forward pass for all sampled frames; rows are [image_id, label, conf, x1, y1, x2, y2]
+    blob = cv2.dnn.blobFromImages(list(frames), 1.0, (FACE_SIZE, FACE_SIZE), (104.0, 177.0, 123.0))
+    with _net_lock:  # concurrent detections must not interleave setInput/forward
+        net.setInput(blob)
+        detections = net.forward().reshape(-1, 7)
+    faces = detections[detections[:, 2] > min_confidence]
+    return (faces[:, 4] + faces[:, 6]) / 2
+
+
+# === FACE POSITION ===
+def detect_face_position(video_path: str, sample_frames=10, min_confidence=0.5):
     """
-    Lightweight version (OpenAI deployment).
-    Skips face detection entirely — always bottom-center captions.
+    Detect face position in video to determine best caption placement.
+
+    Returns SSA alignment value (never raises; any failure falls back to 2):
+    - 2: Bottom center (face in top/middle, no face detected, or detection failed)
+    - 8: Top center (face in bottom third)
     """
-    print(f"[INFO] Skipping face detection for {video_path} (OpenAI mode)")
-    return 2  # bottom center
+    # Best effort: placement is cosmetic, so any model/probe/decode failure must not fail the job
+    try:
+        session = _get_face_session()
+        net = _get_face_net() if session is None else None
+        if session is None and net is None:
+            print(f"[INFO] Skipping face detection for {video_path} (no face model available)")
+            return 2  # bottom center
+
+        # One ffprobe for all metadata: the Shorts check and frame sampling both reuse it
+        width, height, duration = _probe_video(video_path)
+        # Shorts heuristic: short portrait clips nearly always frame the face high → bottom captions
+        if width and height / width > SHORTS_ASPECT and 0 < duration < SHORTS_MAX_SECONDS:
+            return 2
+
+        # Same file (path + mtime + size) → same answer; repeat calls for one video are free
+        stat = os.stat(video_path)
+        return _detect_cached(video_path, stat.st_mtime_ns, stat.st_size, duration, sample_frames, min_confidence)
+    except Exception as e:
+        print(f"[WARN] Face detection failed for {video_path}: {e}; defaulting to bottom center")
+        return 2
+
+
+@lru_cache(maxsize=64)
+def _detect_cached(video_path: str, mtime_ns: int, size: int, duration: float,
+                   sample_frames: int, min_confidence: float) -> int:
+    session = _get_face_session()
+    if session is not None:
+        centers = _ultraface_centers(session, video_path, duration, sample_frames, min_confidence)
+    else:
+        centers = _ssd_centers(_get_face_net(), video_path, duration, sample_frames, min_confidence)
+
+    if not len(centers):
+        return 2
+
+    avg_position = float(centers.mean())
+
+    if avg_position < 0.33:
+        return 2  # Face top third → captions bottom
+    elif avg_position > 0.67:
+        return 8  # Face bottom third → captions top
+    else:
+        return 2  # Face middle → bottom preferred
 
 
 def get_alignment_name(alignment: int) -> str:
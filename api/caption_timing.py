@@ -0,0 +1,38 @@
+"""
+caption_timing.py — caption timestamp post-processing and SRT output shared by both caption pipelines.
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+
+# === OVERLAPS ===
+def resolve_overlaps(starts: np.ndarray, ends: np.ndarray, gap: float = 0.08, min_dur: float = 0.25):
+    """Push every caption at least `gap` past the previous one, in a single vectorized pass."""
+    # e'[i] = max(base[i], e'[i-1] + gap + min_dur) unrolls into a running max over a shifted ramp
+    step = gap + min_dur
+    ramp = np.arange(len(starts)) * step
+    base = np.maximum(ends, starts + min_dur)
+    ends = np.maximum.accumulate(base - ramp) + ramp
+    prev_end = np.concatenate(([-np.inf], ends[:-1]))
+    return np.maximum(starts, prev_end + gap), ends
+
+
+# === SAVE CAPTIONS ===
+def _srt_time(t: float) -> str:
+    """Seconds → SRT timestamp (HH:MM:SS,mmm)."""
+    h, ms = divmod(int(round(t * 1000)), 3_600_000)
+    m, ms = divmod(ms, 60_000)
+    s, ms = divmod(ms, 1000)
+    return f"{h:02d}:{m:02d}:{s:02d},{ms:03d}"
+
+
+def save_srt(segments, srt_path: Path):
+    """Save caption segments as an SRT file."""
+    srt_path.parent.mkdir(parents=True, exist_ok=True)
+    body = "".join(
+        f"{i}\n{_srt_time(seg['start'])} --> {_srt_time(seg['end'])}\n{seg['text'].strip()}\n\n"
+        for i, seg in enumerate(segments, start=1)
+    )
+    srt_path.write_text(body, encoding="utf-8")
@@ -3,13 +3,23 @@ caption_whisper.py — Whisper-based captioning and rendering module.
 Saves final videos in /outputs/videos and SRT files in /outputs/srt.
 """
 
+import os
 import re
 import subprocess
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-import whisper
-import pysrt
+import numpy as np
+import ctranslate2
+from faster_whisper import BatchedInferencePipeline, WhisperModel
 from caption_position import detect_face_position
+from caption_timing import resolve_overlaps, save_srt
+from video_encoder import (
+    CPU_COUNT, DEFAULT_ENCODER, SUBS_FORMAT_FIRST, X264_THREADS,
+    device_args, encoder_args, ffmpeg_escape, run_with_fallback, video_filter,
+)
 
 
 # === PATH SETUP ===
@@ -22,92 +32,160 @@ VIDEOS_DIR.mkdir(parents=True, exist_ok=True)
 SRT_DIR.mkdir(parents=True, exist_ok=True)
 
 
+# === PATTERNS ===
+_CLEAN_TITLE_PUNCT = re.compile(r"[^\w\s-]")
+_CLEAN_TITLE_WS = re.compile(r"\s+")
+_MID_PUNCT = re.compile(r'[,"“”‘’\'?:;!-]')  # straight and curly quotes
+_HIGHLIGHT_WORDS = frozenset({
+    "ai", "work", "money", "content", "effort", "manual", "shorts", "video", "build", "create",
+})
+_WORD = re.compile(r"\w+")  # same boundaries as \b…\b: "AI's", "build-up" still match
+
+
+# === MODEL SETUP ===
+_MODELS: dict[str, WhisperModel] = {}
+_MODELS_LOCK = threading.Lock()
+# Locally converted CTranslate2 weights (whisper-<size>-ct2) win over the hub download by size name
+WHISPER_MODELS_DIR = Path(os.getenv("WHISPER_MODELS_DIR") or Path(__file__).resolve().parent / "models")
+
+# Silero VAD: drop pauses ≥0.5 s so silence and music padding never reach the decoder.
+# The batched pipeline sets max_speech_duration_s to its own 30 s chunk_length, so it is not passed.
+_VAD_MIN_SILENCE_MS = 500
+_VAD_SPEECH_PAD_MS = 200
+# Shorts-length clips transcribe fine on `tiny` (~6× fewer parameters than `small`)
+SHORT_CLIP_SECONDS = 60
+SHORT_CLIP_MODEL = "tiny"
+# Caps simultaneous transcriptions (all entry points) so they can't exhaust GPU/CPU memory
+_TRANSCRIBE_SLOTS = threading.BoundedSemaphore(2)
+
+
+def _load_model(model_size: str) -> WhisperModel:
+    use_cuda = ctranslate2.get_cuda_device_count() > 0
+    device = "cuda" if use_cuda else "cpu"
+    # WHISPER_COMPUTE_TYPE overrides the default, e.g. "float16" on tensor-core GPUs with VRAM to spare
+    compute_type = os.getenv("WHISPER_COMPUTE_TYPE") or ("int8_float16" if use_cuda else "int8")
+    local_dir = WHISPER_MODELS_DIR / f"whisper-{model_size}-ct2"
+    source = str(local_dir) if local_dir.is_dir() else model_size
+    print(f"[INFO] Loading faster-whisper '{source}' → device={device}, compute_type={compute_type}")
+    return WhisperModel(source, device=device, compute_type=compute_type, cpu_threads=CPU_COUNT)
+
+
+def get_whisper_model(model_size: str = "small") -> WhisperModel:
+    """
+    Lazy-load each faster-whisper (CTranslate2) model once per process, int8-quantized.
+    The WhisperModel is safe to share across threads; the BatchedInferencePipeline around it
+    is not (it keeps per-transcription state), so generate_captions wraps it per call.
+    """
+    with _MODELS_LOCK:  # concurrent first requests must not load the same weights twice
+        model = _MODELS.get(model_size)
+        if model is None:
+            model = _MODELS[model_size] = _load_model(model_size)
+    return model
+
+
 # === HELPERS ===
 def clean_title(title: str) -> str:
     """Sanitize a YouTube title to be filesystem-safe."""
-    title = re.sub(r"[^\w\s-]", "", title)
-    title = re.sub(r"\s+", "_", title)
+    title = _CLEAN_TITLE_PUNCT.sub("", title)
+    title = _CLEAN_TITLE_WS.sub("_", title)
     return title.strip("_")
 
 
+def _highlight(match: re.Match) -> str:
+    """Colour a keyword yellow (frozenset lookup on each \\w+ run; punctuation stays white)."""
+    word = match.group()
+    if word.lower() not in _HIGHLIGHT_WORDS:
+        return word
+    return f"{{\\c&H00FFFF&}}{word}{{\\c&HFFFFFF&}}"
+
+
 # === CAPTION GENERATION ===
-def generate_captions(audio_path: str, model_size: str = "small"):
-    """Generate timestamped captions using Whisper."""
-    model = whisper.load_model(model_size)
-    result = model.transcribe(audio_path)
-    segments = result.get("segments", [])
+def load_audio(media_path) -> np.ndarray:
+    """Decode + resample any audio/video file to 16 kHz mono float32 in one piped ffmpeg pass."""
+    pcm = subprocess.run(
+        ["ffmpeg", "-loglevel", "error", "-i", str(media_path),
+         "-vn", "-ac", "1", "-ar", "16000", "-f", "s16le", "-"],
+        capture_output=True, check=True
+    ).stdout
+    return np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+
 
-    micro_segments = []
+def generate_captions(audio, model_size: str | None = None):
+    """
+    Generate timestamped captions using faster-whisper word timestamps.
+    `audio` is a media file path or 16 kHz mono float32 samples from load_audio.
+    The cached model for `model_size` is used, defaulting to SHORT_CLIP_MODEL for clips under
+    SHORT_CLIP_SECONDS and "small" for longer ones.
+    """
+    if not isinstance(audio, np.ndarray):
+        audio = load_audio(audio)
+    if model_size is None:
+        model_size = SHORT_CLIP_MODEL if len(audio) < SHORT_CLIP_SECONDS * 16000 else "small"
+    # at most two decodes at once across /upload and /generate; segments is lazy, so it is
+    # drained inside the slot
+    with _TRANSCRIBE_SLOTS:
+        # fresh pipeline per call: it tracks last_speech_timestamp across chunks of one transcription,
+        # so sharing it between concurrent requests would skew each other's word timings
+        pipeline = BatchedInferencePipeline(model=get_whisper_model(model_size))
+        # greedy, context-free decoding: short-form captions gain little from beam search or
+        # conditioning on previous text, and skipping both avoids decoder recompute.
+        # VAD cuts the audio at silences into ≤30 s speech chunks that are decoded batch_size
+        # at a time; the pipeline maps chunk offsets back to absolute timestamps.
+        segments, _info = pipeline.transcribe(
+            audio,
+            batch_size=16,
+            beam_size=1,
+            best_of=1,
+            temperature=0.0,
+            condition_on_previous_text=False,
+            no_speech_threshold=0.6,
+            vad_filter=True,
+            # fresh dict per call: the pipeline mutates it, and only a dict (not VadOptions) gets the
+            # 30 s chunk_length cap applied as max_speech_duration_s
+            vad_parameters=dict(
+                min_silence_duration_ms=_VAD_MIN_SILENCE_MS, speech_pad_ms=_VAD_SPEECH_PAD_MS
+            ),
+            word_timestamps=True,
+        )
+        segments = list(segments)
+
+    texts, starts, ends = [], [], []
     for seg in segments:
-        words = re.findall(r"\S+", re.sub(r"\s+", " ", seg["text"].strip()))
+        words = [w for w in (seg.words or []) if w.word.strip()]
         if not words:
             continue
 
-        dur = seg["end"] - seg["start"]
-        per_word = dur / len(words)
-        gap = 0.08
-
-        for i in range(0, len(words), 3):
-            chunk = words[i:i + 3]
-            start = seg["start"] + i * per_word
-            end = start + len(chunk) * per_word + 0.25
-            text = " ".join(chunk)
-
-            if 0 < i < len(words) - 3:
-                text = re.sub(r'[,\"""\'?:;!-]', "", text)
-
-            # Highlight key words
-            text = re.sub(
-                r"\b(AI|work|money|content|effort|manual|shorts|video|build|create)\b",
-                r"{\\c&H00FFFF&}\1{\\c&HFFFFFF&}",
-                text,
-                flags=re.IGNORECASE,
-            )
-
-            if micro_segments and start <= micro_segments[-1]["end"]:
-                start = micro_segments[-1]["end"] + gap
-                end = max(start + 0.25, end)
-
-            micro_segments.append({
-                "start": round(start, 2),
-                "end": round(end, 2),
-                "text": text.strip()
-            })
-    return micro_segments
-
-
-# === SAVE CAPTIONS ===
-def save_srt(segments, srt_path: Path):
-    """Save caption segments as an SRT file."""
-    subs = pysrt.SubRipFile()
-    for i, seg in enumerate(segments, start=1):
-        subs.append(
-            pysrt.SubRipItem(
-                index=i,
-                start=pysrt.SubRipTime(seconds=seg["start"]),
-                end=pysrt.SubRipTime(seconds=seg["end"]),
-                text=seg["text"]
-            )
-        )
-    srt_path.parent.mkdir(parents=True, exist_ok=True)
-    subs.save(srt_path, encoding="utf-8")
+        # 3-word chunks: timing straight from the first/last word of each group
+        n = len(words)
+        firsts = np.arange(0, n, 3)
+        lasts = np.minimum(firsts + 2, n - 1)
+        word_starts = np.fromiter((w.start for w in words), dtype=np.float64, count=n)
+        word_ends = np.fromiter((w.end for w in words), dtype=np.float64, count=n)
+        starts.append(word_starts[firsts])
+        ends.append(word_ends[lasts] + 0.25)
 
+        for i in range(0, n, 3):
+            text = " ".join(w.word.strip() for w in words[i:i + 3])
 
-# === BURN CAPTIONS INTO VIDEO ===
-def burn_subtitles(video_path: Path, srt_path: Path, output_path: Path, alignment=2, margin=None):
-    """
-    Burn captions into a video with proper positioning.
-    Saves output to /outputs/videos.
-    """
-    if margin is None:
-        if alignment in [1, 2, 3]:
-            margin = 100  # bottom
-        elif alignment in [4, 5, 6]:
-            margin = 20   # middle
-        else:
-            margin = 150  # top
+            if 0 < i < n - 3:
+                text = _MID_PUNCT.sub("", text)
+            texts.append(_WORD.sub(_highlight, " ".join(text.split())))
+
+    if not texts:
+        return []
+
+    starts, ends = resolve_overlaps(np.concatenate(starts), np.concatenate(ends))
+    return [
+        {"start": start, "end": end, "text": text}
+        for start, end, text in zip(np.round(starts, 2).tolist(), np.round(ends, 2).tolist(), texts)
+    ]
 
-    style = (
+
+# === BURN CAPTIONS INTO VIDEO ===
+@lru_cache(maxsize=32)
+def _style(alignment: int, margin: int) -> str:
+    """ASS force_style for one (alignment, margin) pair, built once and reused."""
+    return (
         f"Fontname=Arial Black,"
         f"Fontsize=20,"
         f"Bold=1,"
@@ -124,64 +202,82 @@ def burn_subtitles(video_path: Path, srt_path: Path, output_path: Path, alignmen
         f"WrapStyle=2"
     )
 
-    vf = f"subtitles='{srt_path}':force_style='{style}',format=yuv420p"
 
-    subprocess.run(
-        [
+def burn_subtitles(video_path: Path, srt_path: Path, output_path: Path, alignment=2, margin=None,
+                   encoder=DEFAULT_ENCODER):
+    """
+    Burn captions into a video with proper positioning.
+    Saves output to /outputs/videos. Audio is stream-copied when the container allows it.
+    """
+    if margin is None:
+        if alignment in [1, 2, 3]:
+            margin = 100  # bottom
+        elif alignment in [4, 5, 6]:
+            margin = 20   # middle
+        else:
+            margin = 150  # top
+
+    subs = f"subtitles='{ffmpeg_escape(srt_path)}':force_style='{_style(alignment, margin)}'"
+    vf = f"format=yuv420p,{subs}" if SUBS_FORMAT_FIRST else f"{subs},format=yuv420p"
+
+    def _cmd(enc, audio_args):
+        return [
             "ffmpeg",
             "-loglevel", "error",
+            "-filter_threads", str(X264_THREADS),
+            *device_args(enc),
             "-i", str(video_path),
-            "-vf", vf,
-            "-c:v", "libx264",
-            "-preset", "fast",
-            "-crf", "23",
-            "-c:a", "aac",
-            "-b:a", "128k",
+            "-map", "0:v:0",
+            "-map", "0:a:0?",
+            "-vf", video_filter(vf, enc),
+            *encoder_args(enc),
+            *audio_args,
             "-movflags", "+faststart",
             "-y", str(output_path)
-        ],
-        check=True
-    )
+        ]
+
+    run_with_fallback(_cmd, encoder)
 
 
 # === FULL CAPTION PIPELINE ===
-def process_caption_video(youtube_url: str):
-    """Download video, transcribe, burn captions, save into /outputs/videos."""
+def process_caption_video(youtube_url: str, alignment: int | None = None):
+    """
+    Download video, transcribe, burn captions, save into /outputs/videos.
+    Pass `alignment` to skip face detection and use that SSA alignment directly.
+    """
     tmpdir = Path(tempfile.mkdtemp())
 
+    # Paths
+    video_path = tmpdir / "video.mp4"
+
+    # One download for everything; the title is printed by the same invocation
     raw_title = subprocess.run(
-        ["yt-dlp", "--get-title", youtube_url],
-        capture_output=True, text=True, check=True
+        ["yt-dlp", "--print", "title", "--no-simulate",
+         "-f", "bv*[ext=mp4][vcodec^=avc1]+ba[ext=m4a]/mp4", "-o", str(video_path), youtube_url],
+        stdout=subprocess.PIPE, text=True, check=True
     ).stdout.strip()
-    title = clean_title(raw_title)
 
-    # Paths
-    audio_path = tmpdir / "audio.mp3"
-    video_path = tmpdir / "video.mp4"
+    title = clean_title(raw_title)
     srt_path = SRT_DIR / f"{title}.srt"
     out_video = VIDEOS_DIR / f"{title}_captioned.mp4"
 
-    # Download both audio & video
-    subprocess.run(
-        ["yt-dlp", "-f", "bestaudio", "-x", "--audio-format", "mp3", "-o", str(audio_path), youtube_url],
-        check=True
-    )
-    subprocess.run(
-        ["yt-dlp", "-f", "bestvideo[ext=mp4][vcodec^=avc1]+bestaudio[ext=m4a]/mp4", "-o", str(video_path), youtube_url],
-        check=True
-    )
-
     if not video_path.exists() or video_path.stat().st_size == 0:
         raise RuntimeError(f"Video download failed for {youtube_url}")
-    if not audio_path.exists() or audio_path.stat().st_size == 0:
-        raise RuntimeError(f"Audio download failed for {youtube_url}")
 
-    # Generate captions
-    segments = generate_captions(str(audio_path))
-    save_srt(segments, srt_path)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        # Face detection only needs the video: run it alongside audio extraction + transcription
+        alignment_future = pool.submit(detect_face_position, str(video_path)) if alignment is None else None
+
+        # Decode audio straight into memory as 16 kHz mono PCM — no intermediate file
+        audio = load_audio(video_path)
+
+        # Generate captions
+        segments = generate_captions(audio)
+        save_srt(segments, srt_path)
 
-    # Determine alignment
-    alignment = detect_face_position(str(video_path))
+        # Determine alignment
+        if alignment_future is not None:
+            alignment = alignment_future.result()
 
     # Burn and export into outputs/videos
     burn_subtitles(video_path, srt_path, out_video, alignment)
@@ -190,6 +286,7 @@ def process_caption_video(youtube_url: str):
         "title": title,
         "video_path": str(video_path),
         "srt_path": str(srt_path),
+        "alignment": alignment,
     }
 
     print(f"[INFO] ✅ Captioned video saved at: {out_video}")
@@ -5,13 +5,16 @@ from fastapi.responses import JSONResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pathlib import Path
+import asyncio
 import tempfile
 import os
 import shutil
-import time
 
 # === LOCAL MODULES ===
-from caption_whisper import process_caption_video, generate_captions, save_srt, burn_subtitles
+from caption_whisper import (
+    process_caption_video, generate_captions, burn_subtitles, get_whisper_model, SHORT_CLIP_MODEL
+)
+from caption_timing import save_srt
 from validate_captions import validate_caption_quality
 from caption_position import detect_face_position
 
@@ -45,6 +48,14 @@ app.add_middleware(
 )
 
 
+# === MODEL WARMUP ===
+@app.on_event("startup")
+def load_whisper_models():
+    """Load both Whisper pipelines once at startup; requests pick one by clip length from the cache."""
+    get_whisper_model()
+    get_whisper_model(SHORT_CLIP_MODEL)
+
+
 # === STATIC FILE SERVING ===
 app.mount("/outputs", StaticFiles(directory=OUTPUTS_DIR), name="outputs")
 if FRONTEND_DIR:
@@ -75,29 +86,38 @@ def serve_video(filename: str):
 
 # === LOCAL VIDEO UPLOAD ===
 @app.post("/upload")
-async def upload_video(file: UploadFile = File(...)):
-    """Upload a video, run local captioning (Whisper + FFmpeg), and return final video."""
+async def upload_video(file: UploadFile = File(...), alignment: int | None = Query(None, ge=1, le=9)):
+    """
+    Upload a video, run local captioning (Whisper + FFmpeg), and return final video.
+    Pass `alignment` (SSA 1–9) to place captions directly and skip face detection.
+    """
     try:
         tmp_dir = Path(tempfile.mkdtemp(prefix="captiongen_"))
         tmp_path = tmp_dir / file.filename
+        # Stream to disk in 1 MB chunks so memory stays flat regardless of upload size
         with open(tmp_path, "wb") as f:
-            f.write(await file.read())
+            while chunk := await file.read(1 << 20):
+                f.write(chunk)
 
         srt_path = SRT_DIR / f"{tmp_path.stem}.srt"
         out_path = VIDEOS_DIR / f"{tmp_path.stem}_captioned.mp4"
 
         print(f"[INFO] 🎬 Processing local video: {tmp_path.name}")
-        segments = generate_captions(str(tmp_path))
+        # Blocking work runs in worker threads so the event loop keeps serving other requests;
+        # transcription and face detection are independent, so they run side by side
+        # (generate_captions itself caps concurrent transcriptions)
+        if alignment is None:
+            segments, alignment = await asyncio.gather(
+                asyncio.to_thread(generate_captions, str(tmp_path)),
+                asyncio.to_thread(detect_face_position, str(tmp_path)),
+            )
+        else:
+            segments = await asyncio.to_thread(generate_captions, str(tmp_path))
         save_srt(segments, srt_path)
+        await asyncio.to_thread(burn_subtitles, tmp_path, srt_path, out_path, alignment)
 
-        alignment = detect_face_position(str(tmp_path))
-        burn_subtitles(tmp_path, srt_path, out_path, alignment)
-
-        for _ in range(20):
-            if out_path.exists() and out_path.stat().st_size > 5000:
-                break
-            time.sleep(0.5)
-        else:
+        # ffmpeg has already exited (burn_subtitles raises on failure); one check for an empty file
+        if not out_path.exists() or out_path.stat().st_size == 0:
             raise RuntimeError(f"FFmpeg output not found: {out_path}")
 
         shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -112,22 +132,18 @@ async def upload_video(file: UploadFile = File(...)):
 
 # === YOUTUBE CAPTIONING ===
 @app.get("/generate")
-def generate_from_youtube(youtube_url: str = Query(...)):
-    """Fetch a YouTube Shorts, caption it, and return metadata."""
+def generate_from_youtube(youtube_url: str = Query(...), alignment: int | None = Query(None, ge=1, le=9)):
+    """Fetch a YouTube Shorts, caption it, and return metadata. `alignment` skips face detection."""
     try:
         print(f"[INFO] 📥 Fetching YouTube video: {youtube_url}")
-        output_path, meta = process_caption_video(youtube_url)
+        output_path, meta = process_caption_video(youtube_url, alignment=alignment)
         out_path = Path(output_path).resolve()
 
-        for _ in range(30):
-            if out_path.exists() and out_path.stat().st_size > 10000:
-                break
-            time.sleep(0.5)
-        else:
+        if not out_path.exists() or out_path.stat().st_size == 0:
             raise RuntimeError(f"Output not found: {out_path}")
 
         score = validate_caption_quality(meta["srt_path"])
-        alignment = detect_face_position(meta["video_path"])
+        alignment = meta["alignment"]
 
         print(f"[INFO] ✅ Completed captioning for: {meta.get('title', 'Untitled')}")
 
@@ -149,4 +165,4 @@ def generate_from_youtube(youtube_url: str = Query(...)):
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8000))
-    uvicorn.run("ssm_server:app", host="0.0.0.0", port=port, reload=True)
+    uvicorn.run("main:app", host="0.0.0.0", port=port, loop="uvloop", http="httptools")
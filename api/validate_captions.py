@@ -1,26 +1,32 @@
+import numpy as np
 import pysrt
 
 #validate captions (check from grammar, punctuations etc.)
 def validate_caption_quality(srt_path: str, max_words: int = 6, min_gap: float = 0.05):
     """Validate caption density, readability, and timing overlaps."""
     subs = pysrt.open(srt_path)
-    issues = []
+    n = len(subs)
 
-    for i, sub in enumerate(subs):
-        word_count = len(sub.text.split())
-        if word_count > max_words:
-            issues.append(f"[{i+1}] Too many words ({word_count})")
+    # one pass over the parsed subs, then every check runs on flat arrays
+    word_counts = np.fromiter((len(sub.text.split()) for sub in subs), dtype=np.int32, count=n)
+    starts = np.fromiter((sub.start.ordinal for sub in subs), dtype=np.int64, count=n)
+    ends = np.fromiter((sub.end.ordinal for sub in subs), dtype=np.int64, count=n)
+    gaps = (starts[1:] - ends[:-1]) / 1000
 
-        if i < len(subs) - 1:
-            gap = (subs[i + 1].start.ordinal - sub.end.ordinal) / 1000
-            if gap < min_gap:
-                issues.append(f"[{i+1}] Short/overlap gap ({gap:.2f}s)")
+    too_wordy = word_counts > max_words
+    too_close = np.zeros(n, dtype=bool)
+    too_close[:-1] = gaps < min_gap
+    issue_count = int(too_wordy.sum() + too_close.sum())
 
-    if issues:
+    if issue_count:
+        # messages are only built for the captions that actually failed a check
         print("Validation issues found:")
-        for issue in issues:
-            print("  ", issue)
-        score = max(0, 100 - len(issues) * 5)
+        for i in np.flatnonzero(too_wordy | too_close):
+            if too_wordy[i]:
+                print("  ", f"[{i+1}] Too many words ({word_counts[i]})")
+            if too_close[i]:
+                print("  ", f"[{i+1}] Short/overlap gap ({gaps[i]:.2f}s)")
+        score = max(0, 100 - issue_count * 5)
     else:
         print("Captions validated successfully.")
         score = 100
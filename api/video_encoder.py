@@ -0,0 +1,160 @@
+"""
+video_encoder.py — H.264 encoder selection shared by both caption pipelines.
+Picks the first hardware encoder that can actually open a session on this host
+(checked once with a 1-frame test encode), else libx264.
+"""
+
+import math
+import os
+import re
+import subprocess
+
+
+# === SETTINGS ===
+HW_ENCODERS = ("h264_nvenc", "h264_videotoolbox", "h264_vaapi", "h264_qsv")
+# VAAPI (Linux Intel/AMD) needs a DRM render node; the encoder being compiled in is not enough
+VAAPI_DEVICE = os.getenv("VAAPI_DEVICE", "/dev/dri/renderD128")
+def _cpu_count() -> int:
+    """Cores this process may actually use: CPU affinity, further capped by a cgroup CPU quota."""
+    count = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 4
+    # affinity ignores CFS quotas, e.g. a 16-CPU container limit on a 96-core host
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:  # cgroup v2: "<quota> <period>" or "max <period>"
+            quota, period = f.read().split()[:2]
+    except (OSError, ValueError):
+        try:  # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as q, \
+                    open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as p:
+                quota, period = q.read().strip(), p.read().strip()
+        except OSError:
+            return count
+    if quota in ("max", "-1") or int(period) <= 0:
+        return count
+    return max(1, min(count, math.ceil(int(quota) / int(period))))
+
+
+CPU_COUNT = _cpu_count()
+X264_THREADS = min(CPU_COUNT, 4)
+# Shorts are tiny: veryfast by default, CAPTIONS_FAST_ENCODE=1 → ultrafast,
+# CAPTIONGEN_X264_PRESET overrides both (e.g. "fast" for quality-sensitive deployments)
+X264_PRESET = os.getenv("CAPTIONGEN_X264_PRESET") or (
+    "ultrafast" if os.getenv("CAPTIONS_FAST_ENCODE") == "1" else "veryfast"
+)
+# CAPTIONS_FORMAT_FIRST=1 converts to yuv420p before libass so it blends straight onto the
+# output planes; faster on most builds, but benchmark — some are quicker with the default order
+SUBS_FORMAT_FIRST = os.getenv("CAPTIONS_FORMAT_FIRST") == "1"
+
+# The path sits inside subtitles='...', where the graph-level parser keeps backslashes literally
+# and the option-level parser then unescapes them. A quote can't be escaped inside quotes, so it
+# closes the quote, emits \\\' (→ \' → ') and reopens.
+_FFMPEG_ESCAPES = str.maketrans({"\\": "\\\\", ":": "\\:", "'": r"'\\\''", ",": r"\,"})
+
+AUDIO_COPY = ["-c:a", "copy"]
+AUDIO_AAC = ["-c:a", "aac", "-b:a", "128k"]
+# ffmpeg stderr that means "this encoder / audio copy can't work here" rather than a bad input.
+# Only encoder-open failures: ffmpeg ≥6.1 prefixes every error with the encoder name
+# ("[vost#0:0/h264_nvenc @ …]"), so a bare "nvenc"/"vaapi"/"device" would match unrelated errors.
+_ENCODER_FAILURE = re.compile(
+    r"Error while opening encoder|Cannot load|OpenEncodeSessionEx|No (?:NVENC )?capable devices|MFX"
+    r"|Failed to initialise VAAPI"
+)
+_AUDIO_COPY_FAILURE = re.compile(
+    r"Could not find tag for codec|not currently supported in container", re.IGNORECASE
+)
+
+
+# === FFMPEG ARGUMENTS ===
+def encoder_args(encoder: str, quality: int = 23) -> list:
+    """ffmpeg video-codec arguments for the given encoder at a CRF-like quality level."""
+    if encoder == "h264_nvenc":
+        return ["-c:v", "h264_nvenc", "-preset", "p4", "-tune", "ll", "-rc", "vbr",
+                "-cq", str(quality), "-b:v", "0"]
+    if encoder == "h264_videotoolbox":
+        return ["-c:v", "h264_videotoolbox", "-b:v", "4M"]
+    if encoder == "h264_vaapi":
+        return ["-c:v", "h264_vaapi", "-qp", str(quality)]
+    if encoder == "h264_qsv":
+        return ["-c:v", "h264_qsv", "-global_quality", str(quality)]
+    # software fallback: thread count pinned so x264 does not oversubscribe many-core hosts
+    return ["-c:v", "libx264", "-preset", X264_PRESET, "-tune", "fastdecode,zerolatency", "-crf", str(quality),
+            "-threads", str(X264_THREADS),
+            "-x264-params", f"threads={X264_THREADS}:lookahead_threads=2:sliced_threads=0"]
+
+
+def device_args(encoder: str) -> list:
+    """Global options that must precede the input (hardware device setup)."""
+    return ["-vaapi_device", VAAPI_DEVICE] if encoder == "h264_vaapi" else []
+
+
+def ffmpeg_escape(path) -> str:
+    """Escape a path for use inside an ffmpeg filter argument (single str.translate pass)."""
+    return str(path).translate(_FFMPEG_ESCAPES)
+
+
+def video_filter(vf: str, encoder: str) -> str:
+    """Finish a software filter chain for the encoder; VAAPI takes frames as nv12 surfaces."""
+    return f"{vf},format=nv12,hwupload" if encoder == "h264_vaapi" else vf
+
+
+def run_with_fallback(build_cmd, encoder: str):
+    """
+    Run ffmpeg as build_cmd(encoder, audio_args), stream-copying audio first.
+    Falls back to AAC when the audio codec can't go into mp4 and to libx264 when the encoder
+    can't open; any other failure (bad input, bad subtitles) is raised after a single run.
+    """
+    attempts = [(encoder, AUDIO_COPY), (encoder, AUDIO_AAC)]
+    if encoder != "libx264":
+        attempts += [("libx264", AUDIO_COPY), ("libx264", AUDIO_AAC)]
+
+    failed_encoders, copy_failed = set(), False
+    for enc, audio_args in attempts:
+        if enc in failed_encoders or (copy_failed and audio_args is AUDIO_COPY):
+            continue
+        proc = subprocess.run(build_cmd(enc, audio_args), stderr=subprocess.PIPE, text=True, errors="replace")
+        if proc.returncode == 0:
+            return
+        print(f"[WARN] ffmpeg burn failed ({enc}, {' '.join(audio_args)}): {proc.stderr.strip()[-500:]}")
+        if _AUDIO_COPY_FAILURE.search(proc.stderr):
+            copy_failed = True
+        elif _ENCODER_FAILURE.search(proc.stderr):
+            failed_encoders.add(enc)
+        else:
+            break
+    raise subprocess.CalledProcessError(proc.returncode, proc.args, stderr=proc.stderr)
+
+
+# === PROBE ===
+def _can_encode(encoder: str) -> bool:
+    """1-frame test encode: listed in -encoders is not enough when the GPU/driver is missing."""
+    try:
+        subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", *device_args(encoder),
+             "-f", "lavfi", "-i", "color=s=256x256:d=0.1", "-frames:v", "1",
+             "-vf", video_filter("format=yuv420p", encoder), *encoder_args(encoder),
+             "-f", "null", "-"],
+            capture_output=True, check=True, timeout=20
+        )
+    except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        return False
+    return True
+
+
+def probe_encoder() -> str:
+    """Pick the first hardware H.264 encoder that works on this host, else libx264."""
+    try:
+        encoders = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            capture_output=True, text=True, check=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "libx264"
+    usable = (enc for enc in HW_ENCODERS
+              if enc in encoders
+              and (enc != "h264_vaapi" or os.path.exists(VAAPI_DEVICE))
+              and _can_encode(enc))
+    encoder = next(usable, "libx264")
+    print(f"[INFO] Video encoder: {encoder}")
+    return encoder
+
+
+DEFAULT_ENCODER = probe_encoder()
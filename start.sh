@@ -6,5 +6,7 @@ echo "🚀 Starting CaptionGen FastAPI server..."
 # Change to correct directory
 cd /app/api
 
-# Start FastAPI via Uvicorn
-uvicorn main:app --host 0.0.0.0 --port ${PORT:-8000}
+# Start FastAPI via Uvicorn (uvloop + httptools ship with uvicorn[standard]).
+# Each worker loads its own Whisper model, so raise WEB_CONCURRENCY only if memory allows.
+uvicorn main:app --host 0.0.0.0 --port ${PORT:-8000} \
+  --workers ${WEB_CONCURRENCY:-1} --loop uvloop --http httptools --no-access-log